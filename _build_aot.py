@@ -0,0 +1,24 @@
+"""
+Builds _pynamic_native, an ahead of time compiled module with the array 
+arithmetic of the RK steps. pynamic_ode(..., jit=False) uses it so that no 
+numba compilation happens at run time. Run this once after installing:
+    python _build_aot.py
+The compiled module is written next to this file.
+"""
+
+from numba.pycc import CC
+import pynamic
+
+cc = CC("_pynamic_native")
+
+#a version of each function for both float types pynamic_ode supports
+for suffix, float_type in (("_f64", "f8"), ("_f32", "f4")):
+    arr = float_type + "[:]"
+    cc.export("axpy" + suffix, "void(%s, f8, %s, %s)"%(arr, arr, arr))(
+        pynamic._axpy)
+    cc.export("rk4_combine" + suffix, 
+              "void(%s, f8, %s, %s, %s, %s, %s)"%((arr,)*6))(
+                  pynamic._rk4_combine)
+
+if __name__ == '__main__':
+    cc.compile()
@@ -1,29 +1,259 @@
 """
 Pynamic ODE - an ODE integrator with dynamic time steps. Can be run as RK1 
-(faster) or RK4 (slower, but more accurate).
+(faster) or RK4 (slower, but more accurate). pynamic_ode_dp5 uses the 
+Dormand-Prince 5(4) method instead, with the time step set from an error 
+estimate.
 """
 
+import inspect
+import math
+import weakref
 import numpy as np
+import numba
+
+try:
+    #precompiled step arithmetic for the interpreted loop, see _build_aot.py
+    import _pynamic_native
+except ImportError:
+    _pynamic_native = None
+
+#numba.cuda, only imported by pynamic_ode_batch_cuda since it's slow to import
+cuda = None
+
+#options used for every compiled routine in this module. error_model='numpy'
+#lets divisions by zero produce inf/nan instead of raising, which skips the
+#per-division zero checks in the compiled code. Only routines that don't take
+#the user's functions are cached on disk (cache=True): numba compiles a loop
+#for each function it's passed, and those can't be loaded by another process
+#since the functions are new objects there.
+_JIT_OPTIONS = dict(fastmath=True, error_model='numpy')
+
+#number of steps the output arrays can hold before they are grown
+_INITIAL_CAPACITY = 1024
+
+#a step counts as the smallest allowed step if it's within this factor of 
+#min_step_time, in case repeated halving left it just above it
+_MIN_STEP_TOL = 1 + 1e-12
+
+#jitted versions of user functions, keyed by the original function so that
+#repeated calls with the same func don't trigger a recompile of the driver. 
+#The caches of user functions are weak, so a function that's defined for 
+#each call (like a closure) is freed with its compiled versions afterwards.
+_jitted_funcs = weakref.WeakKeyDictionary()
+
+def _detached_copy(func):
+    """
+    Return a copy of the Python function func that shares its code, globals
+    and closure, but doesn't reference func itself. A compiled version of 
+    the copy can be stored in a weak cache keyed by func without keeping 
+    func alive, which a compiled version of func itself would (through its
+    py_func).
+    """
+    func_copy = type(func)(func.__code__, func.__globals__, func.__name__,
+                           func.__defaults__, func.__closure__)
+    func_copy.__kwdefaults__ = func.__kwdefaults__
+    func_copy.__qualname__ = func.__qualname__
+    return func_copy
+
+def _jit(func):
+    """
+    Return a numba compiled version of func. Functions that are already
+    compiled (decorated with numba.njit) are returned as is.
+    """
+    if numba.extending.is_jitted(func):
+        return func
+    #one lookup, since each lookup in a weak dictionary makes a new weakref
+    jitted_func = _jitted_funcs.get(func)
+    if jitted_func is None:
+        #no disk caching here, user functions may not live in a file
+        jitted_func = numba.njit(fastmath=True, 
+                                 error_model='numpy')(_detached_copy(func))
+        _jitted_funcs[func] = jitted_func
+    return jitted_func
+
+#number of arguments of user functions, see _num_args()
+_arg_counts = weakref.WeakKeyDictionary()
+
+def _num_args(func):
+    """
+    Return the number of arguments func takes. Works for numba compiled 
+    functions too. The count is cached, since inspecting the signature takes
+    longer than a short integration.
+    """
+    num_args = _arg_counts.get(func)
+    if num_args is None:
+        num_args = len(inspect.signature(
+            getattr(func, "py_func", func)).parameters)
+        _arg_counts[func] = num_args
+    return num_args
+
+#in place versions of user functions, see _as_inplace()
+_inplace_funcs = weakref.WeakKeyDictionary()
+
+def _as_inplace(func):
+    """
+    Return a compiled version of func that writes the derivatives to an 
+    output array:
+        inplace_func(time_step, y_vals, derivs)
+    This lets the integration loop reuse the same derivative arrays each step.
+    If func already takes the output array it's only compiled, otherwise it's
+    wrapped in a function that copies its return value to the array.
+    """
+    inplace_func = _inplace_funcs.get(func)
+    if inplace_func is None:
+        jitted_func = _jit(func)
+
+        if _num_args(func) == 3:
+            inplace_func = jitted_func
+        else:
+            @numba.njit(fastmath=True, error_model='numpy')
+            def inplace_func(time_step, y_vals, derivs):
+                derivs[:] = jitted_func(time_step, y_vals)
+
+        _inplace_funcs[func] = inplace_func
+    return inplace_func
+
+def _uses_old_vals(end_condition):
+    """
+    Return True if end_condition takes the previous values as well:
+        end_condition(current_time, y_vals, y_vals_old)
+    If it only takes end_condition(current_time, y_vals) the integration
+    loops don't need to keep a copy of the previous values.
+    """
+    return _num_args(end_condition) == 3
+
+def _add_old_vals_arg(end_condition):
+    """
+    Wrap an end condition that doesn't take the previous values so it can be
+    called like one that does. The wrapper is plain Python so it can be
+    compiled for whichever target needs it (see _jit_end_condition()).
+    """
+    def wrapped_end_condition(current_time, y_vals, y_vals_old):
+        return end_condition(current_time, y_vals)
+    return wrapped_end_condition
+
+#compiled 3 argument versions of end conditions and whether the originals
+#use the old values, see _jit_end_condition()
+_end_conditions = weakref.WeakKeyDictionary()
+
+def _jit_end_condition(end_condition):
+    """
+    Return a compiled version of end_condition that takes the current time,
+    the values and the previous values, whether or not end_condition itself
+    takes the previous values, and track_old, which is True if it does (see
+    _uses_old_vals()).
+    """
+    compiled = _end_conditions.get(end_condition)
+    if compiled is None:
+        jitted_end_condition = _jit(end_condition)
+        track_old = _uses_old_vals(end_condition)
+        if not track_old:
+            jitted_end_condition = numba.njit(fastmath=True,
+                error_model='numpy')(_add_old_vals_arg(jitted_end_condition))
+        compiled = (jitted_end_condition, track_old)
+        _end_conditions[end_condition] = compiled
+    return compiled
+
+#return types of compiled end conditions by dtype, see _end_condition_type()
+_end_condition_types = weakref.WeakKeyDictionary()
+
+def _end_condition_type(end_condition, dtype):
+    """
+    Return the numba type that end_condition, compiled by 
+    _jit_end_condition(), returns when it's called with values of dtype. The
+    loops return it as the status, so a TypeError is raised if it isn't a 
+    number.
+    """
+    types_by_dtype = _end_condition_types.setdefault(end_condition, {})
+    if dtype not in types_by_dtype:
+        vals = numba.from_dtype(dtype)[::1]
+        args = (numba.float64, vals, vals)
+        end_condition.compile(args)
+        return_type = numba.types.unliteral(
+            end_condition.overloads[args].signature.return_type)
+        if not isinstance(return_type, (numba.types.Integer, 
+                                        numba.types.Float, 
+                                        numba.types.Boolean)):
+            raise TypeError("end_condition must return a number, not %s"%
+                            return_type)
+        types_by_dtype[dtype] = return_type
+    return types_by_dtype[dtype]
+
+#first class versions of the compiled user functions by signature, see 
+#_loop_funcs()
+_first_class_funcs = weakref.WeakKeyDictionary()
+
+def _loop_funcs(func, end_condition, dtype, first_class):
+    """
+    Return func wrapped by _as_inplace() and end_condition and track_old 
+    from _jit_end_condition(), ready to pass to the compiled loops. If 
+    first_class, func and end_condition are compiled as numba.cfunc's for 
+    arrays of dtype instead. The loops then type them as first class
+    functions (numba.types.FunctionType) with just their signature, rather
+    than as a type specific to each function, so a loop only has to be
+    compiled once for every func and end_condition and can be cached on disk.
+    """
+    func = _as_inplace(func)
+    end_condition, track_old = _jit_end_condition(end_condition)
+
+    if first_class:
+        vals = numba.from_dtype(dtype)[::1]
+        func_sig = numba.types.void(numba.float64, vals, vals)
+        #the same return type as the compiled end_condition, so the status 
+        #is the same as without first_class
+        end_sig = _end_condition_type(end_condition, dtype)(numba.float64, 
+                                                           vals, vals)
+        for jitted_func, sig in ((func, func_sig), (end_condition, end_sig)):
+            cfuncs = _first_class_funcs.setdefault(jitted_func, {})
+            if sig not in cfuncs:
+                cfuncs[sig] = numba.cfunc(sig, fastmath=True, 
+                    error_model='numpy')(jitted_func.py_func)
+        func = _first_class_funcs[func][func_sig]
+        end_condition = _first_class_funcs[end_condition][end_sig]
+
+    return func, end_condition, track_old
+
+def _monitor_index(param_to_monitor, num_vals):
+    """
+    Return param_to_monitor as an index from 0 to num_vals - 1. The compiled
+    loops don't check array bounds, so an index that is out of range for 
+    num_vals values raises an IndexError here instead, like indexing the 
+    values in Python would.
+    """
+    param_to_monitor = int(param_to_monitor)
+    if not -num_vals <= param_to_monitor < num_vals:
+        raise IndexError("param_to_monitor %d is out of range for %d values"%
+                         (param_to_monitor, num_vals))
+    return param_to_monitor % num_vals
 
 def pynamic_ode(func, start_time, max_time, initial_val, 
                 param_to_monitor, max_param_delta,
                 base_time_step, min_step_time, end_condition,
-                use_rk4=True):
+                use_rk4=True, backend='native', scipy_method='LSODA', 
+                jit=True, dtype=np.float64, monitor_atol=0.0, 
+                first_class=False):
     """
     Solves a system of ordinary differential equations with dynamic time steps.
     The passed in function (func) should take two arguments, a time step value,
     and the current parameter values. It will have the form:
         func(time_step, y_vals)
     The func provided should return the derivatives of each value considered.
+    Alternatively func can take a third argument, an array to write the 
+    derivatives into instead of returning them:
+        func(time_step, y_vals, derivs)
+    which saves allocating a new array every time func is called. 
     This routine will start at time start_time, and run until max_time is 
     reached, or the end condition is met. The end condition is set by the
     end_condition paramter, which should be a function similar to func but that 
     takes the current time (NOT TIME STEP), the current system values, and the
     previous values of the system - like:
         end_condition(current_time, y_vals, y_vals_old)
-    and should return 0 if the integration should continue, or not 0 if it 
-    should terminate (the value returned by end_condition will be returned to 
-    the caller so you can process why the integration ended). 
+    and should return 0 if the integration should continue, or not 0 if it
+    should terminate (the value returned by end_condition will be returned to
+    the caller so you can process why the integration ended). If the previous
+    values aren't needed end_condition can leave them out:
+        end_condition(current_time, y_vals)
+    which saves copying the values every step.
 
     This solver will attempt each time step and if the % change in the monitored 
     parameter is greater than the provided max_param_delta (as a fraction), then
@@ -34,10 +264,34 @@ def pynamic_ode(func, start_time, max_time, initial_val,
     if the initial guess has values:
         initial_val = [position, velocity]
     and you want to make sure the position never changes by more than 1% you'd
-    set param_to_monitor=0 and max_param_delta=0.01. 
+    set param_to_monitor=0 and max_param_delta=0.01. If the monitored parameter
+    can be 0, or cross 0, set monitor_atol too: changes are then allowed up 
+    to max_param_delta*|value| + monitor_atol, otherwise any change away from 
+    0 is an infinite % change and can never be accepted.
+
+    The integration loop is compiled with numba, so func and end_condition must
+    be compilable in nopython mode (numba.njit). They can be passed in already
+    decorated with numba.njit, otherwise they will be compiled on first use. 
+    If func returns the derivatives it should return a numpy array. Compiling
+    takes a few seconds the first time func is used in a session, which can 
+    be longer than a short integration takes. With jit=False nothing is 
+    compiled: the loop runs in the interpreter and func and end_condition are
+    called as regular Python functions, with only the array arithmetic 
+    precompiled (run _build_aot.py once to build it ahead of time). With 
+    first_class=True only func and end_condition are compiled for each new 
+    func, the loop is compiled once and cached on disk (see first_class).
+
+    With backend='scipy' the integration is done by one of the solvers in 
+    scipy.integrate instead (LSODA by default, see scipy_method), which have 
+    compiled cores and their own error control. max_param_delta is used as 
+    the relative tolerance of every value and base_time_step as the largest 
+    step. param_to_monitor, min_step_time and use_rk4 aren't used. Since the
+    scipy solvers pick their own internal steps func is always passed 
+    base_time_step as the time step. end_condition is still checked after 
+    every step, and neither function needs to be compilable by numba.
     Inputs:
         func             - function that takes time step and values, returns 
-                           derivatives
+                           derivatives (or writes them to its third argument)
         start_time       - simulation start time [s]
         max_time         - maximum time to run simulation before returning an 
                            error [s]
@@ -50,33 +304,233 @@ def pynamic_ode(func, start_time, max_time, initial_val,
         min_step_time    - the smallest time step to allow. If max_param_delta 
                            is exceeded at the smallest allowed time step an 
                            error status will be returned.
-        end_condition    - function that takes current time and values and the 
-                           previous values. This function will return 
+        end_condition    - function that takes current time and values and
+                           (optionally) the previous values. It will return
                            not 0 if the integration should end, 0 otherwise. The
                            value of end condition will be passed out of this 
                            function.
         use_rk4          - default is True. If true, use the RK4 method, if 
                            false, use the RK1 (Euler) method.
+        backend          - default is 'native'. 'native' runs the compiled 
+                           solver in this module, 'scipy' uses scipy.integrate.
+        scipy_method     - name of the scipy.integrate solver class used with
+                           backend='scipy', e.g. 'LSODA', 'DOP853' or 'RK45'.
+        jit              - default is True. If False, run the native backend 
+                           without compiling func, end_condition or the loop.
+        dtype            - default is np.float64. The float type the values 
+                           are stored as with the native backend. np.float32
+                           halves the memory used, which helps for big systems
+                           or batches if the tolerances allow it. Times are 
+                           always np.float64.
+        monitor_atol     - default is 0. Absolute change to tolerate in 
+                           param_to_monitor on top of max_param_delta.
+        first_class      - default is False. If True, func and end_condition
+                           are passed to the compiled loop as first class 
+                           functions (numba.cfunc's), so the loop doesn't 
+                           have to be recompiled for each func. Only func and
+                           end_condition are compiled on the first call,
+                           which takes a fraction of the time compiling the
+                           loop does, but the calls can't be inlined, which
+                           adds ~15us to each call and a few % on long
+                           integrations.
     Returns:
         times  - the array of time values [s] calculated 
-        y_vals     - the array of parameter values at each time step
+        y_vals - 2D array of parameter values, one row per time step
         status - the status of the solver. Values are:
                     -1 : failure because max_param_delta was exceeded at the 
-                         smallest allowed time step.
+                         smallest allowed time step (or the scipy solver 
+                         failed).
                      0 : simulation ended without meeting end condition (it hit
                          max_time).
                     >0 : simulation reached end condition successfully. Return
                          the result of end_condition.
     """
 
-    y_cur = np.array(initial_val)
-    y_old = np.zeros_like(y_cur)
+    y_cur = np.array(initial_val, dtype=dtype)
+
+    if backend == 'scipy':
+        return _pynamic_ode_scipy(func, start_time, max_time, y_cur, 
+                                  max_param_delta, base_time_step, 
+                                  end_condition, scipy_method)
+    if backend != 'native':
+        raise ValueError("unknown backend %r, expected 'native' or 'scipy'"%
+                         backend)
+
+    param_to_monitor = _monitor_index(param_to_monitor, y_cur.shape[0])
+
+    if not jit:
+        return _pynamic_ode_py(func, start_time, max_time, y_cur, 
+                               param_to_monitor, max_param_delta, monitor_atol,
+                               base_time_step, min_step_time, end_condition, 
+                               use_rk4)
 
-    times = []
-    y_vals = []
+    loop_func, loop_end_condition, track_old = \
+        _loop_funcs(func, end_condition, y_cur.dtype, first_class)
+    driver = _pynamic_ode_jit_cached if first_class else _pynamic_ode_jit
+
+    return driver(loop_func, float(start_time), float(max_time), y_cur, 
+                  param_to_monitor, float(max_param_delta), 
+                  float(monitor_atol), float(base_time_step), 
+                  float(min_step_time), loop_end_condition, track_old, 
+                  bool(use_rk4))
+
+def _pynamic_ode_scipy(func, start_time, max_time, initial_val, rtol, 
+                       max_step, end_condition, method):
+    """
+    Integrate with a scipy.integrate solver, stepping it one step at a time 
+    so end_condition can be checked the same way as in _pynamic_ode_jit.
+    """
+    #scipy is only needed for this backend, so only import it here
+    from scipy import integrate
+
+    if _num_args(func) == 3:
+        def scipy_func(_, y_vals):
+            derivs = np.empty_like(y_vals)
+            func(max_step, y_vals, derivs)
+            return derivs
+    else:
+        def scipy_func(_, y_vals):
+            return func(max_step, y_vals)
+
+    if not _uses_old_vals(end_condition):
+        end_condition = _add_old_vals_arg(end_condition)
+
+    solver = getattr(integrate, method)(scipy_func, start_time, initial_val, 
+                                        max_time, max_step=max_step, 
+                                        rtol=rtol)
+
+    times = [solver.t]
+    y_vals = [solver.y]
+    y_old = np.zeros_like(solver.y)
+    status = 0 #status of the solver
+
+    while solver.status == 'running':
+        end_val = end_condition(solver.t, solver.y, y_old)
+        y_old = solver.y
+        if end_val != 0:
+            status = abs(end_val) #success!
+            break
+
+        solver.step()
+        if solver.status == 'failed':
+            status = -1
+            break
+
+        #the solvers create a new y array each step, so no copy is needed
+        times.append(solver.t)
+        y_vals.append(solver.y)
+
+    return np.array(times), np.array(y_vals), status
+
+def _pynamic_ode_py(func, start_time, max_time, initial_val, 
+                    param_to_monitor, max_param_delta, monitor_atol,
+                    base_time_step, min_step_time, end_condition, use_rk4):
+    """
+    Run the _integrate loop in the interpreter, for pynamic_ode(jit=False). 
+    The loop's array arithmetic uses the precompiled _pynamic_native module 
+    if it has been built, otherwise the numba versions of those functions 
+    (which are cached on disk after the first compile).
+    """
+    if _num_args(func) == 3:
+        inplace_func = func
+    else:
+        def inplace_func(time_step, y_vals, derivs):
+            derivs[:] = func(time_step, y_vals)
+
+    track_old = _uses_old_vals(end_condition)
+    if not track_old:
+        end_condition = _add_old_vals_arg(end_condition)
+
+    #the precompiled array arithmetic for this dtype if there is any
+    suffix = {np.float64: "_f64", np.float32: "_f32"}.get(
+        initial_val.dtype.type)
+    if _pynamic_native is not None and suffix is not None:
+        axpy = getattr(_pynamic_native, "axpy" + suffix)
+        rk4_combine = getattr(_pynamic_native, "rk4_combine" + suffix)
+    else:
+        axpy = _axpy_jit
+        rk4_combine = _rk4_combine_jit
+
+    times = np.empty(_INITIAL_CAPACITY)
+    y_vals = np.empty((_INITIAL_CAPACITY, initial_val.shape[0]), 
+                      initial_val.dtype)
+
+    times, y_vals, num_steps, status = \
+        _integrate.py_func(inplace_func, start_time, max_time, initial_val, 
+                           param_to_monitor, max_param_delta, monitor_atol, 
+                           base_time_step, min_step_time, end_condition, 
+                           track_old, use_rk4, axpy, rk4_combine, times, 
+                           y_vals, True)
+
+    return times[:num_steps], y_vals[:num_steps], status
+
+@numba.njit(**_JIT_OPTIONS)
+def _pynamic_ode_jit(func, start_time, max_time, initial_val, 
+                     param_to_monitor, max_param_delta, monitor_atol,
+                     base_time_step, min_step_time, end_condition,
+                     track_old, use_rk4):
+    """
+    The compiled version of pynamic_ode. Takes the same inputs, with func and
+    end_condition from _loop_funcs(). track_old is False if the original
+    end_condition doesn't use the previous values, so they don't need to be
+    kept.
+    """
+    times = np.empty(_INITIAL_CAPACITY)
+    y_vals = np.empty((_INITIAL_CAPACITY, initial_val.shape[0]), 
+                      initial_val.dtype)
+
+    times, y_vals, num_steps, status = \
+        _integrate(func, start_time, max_time, initial_val, param_to_monitor, 
+                   max_param_delta, monitor_atol, base_time_step, 
+                   min_step_time, end_condition, track_old, use_rk4, _axpy, 
+                   _rk4_combine, times, y_vals, True)
+
+    return times[:num_steps], y_vals[:num_steps], status
+
+#the same loop for first_class funcs. Their types only depend on the dtype, 
+#so the compiled loops can be loaded from the disk cache by other processes.
+_pynamic_ode_jit_cached = numba.njit(cache=True, **_JIT_OPTIONS)(
+    _pynamic_ode_jit.py_func)
+
+@numba.njit(**_JIT_OPTIONS)
+def _integrate(func, start_time, max_time, initial_val, param_to_monitor, 
+               max_param_delta, monitor_atol, base_time_step, min_step_time, 
+               end_condition, track_old, use_rk4, axpy, rk4_combine, times, 
+               y_vals, grow):
+    """
+    The integration loop behind pynamic_ode and pynamic_ode_batch. Takes the 
+    same inputs as _pynamic_ode_jit plus the array arithmetic to use, axpy 
+    and rk4_combine (see _axpy and _rk4_combine), and the arrays to store the
+    results in, times and y_vals. If grow is True these are doubled in size 
+    when they fill up, otherwise the integration stops with status -2. 
+    Returns the (possibly new) times and y_vals arrays, the number of steps 
+    stored in them and the status.
+    """
+
+    #initial_val is copied since y_cur is reused as a scratch array
+    y_cur = initial_val.copy()
+    #the first call to end_condition sees zeros as the old values. If it 
+    #doesn't read them y_old is never touched, so skip filling it.
+    if track_old:
+        y_old = np.zeros_like(y_cur)
+    else:
+        y_old = np.empty_like(y_cur)
+
+    #scratch arrays reused every step so the loop doesn't allocate. y_new is
+    #swapped with y_cur when a step is accepted.
+    num_vals = y_cur.shape[0]
+    rk4_k1 = np.empty_like(y_cur)
+    rk4_k2 = np.empty_like(y_cur)
+    rk4_k3 = np.empty_like(y_cur)
+    rk4_k4 = np.empty_like(y_cur)
+    y_tmp = np.empty_like(y_cur)
+    y_new = np.empty_like(y_cur)
+
+    capacity = times.shape[0] #number of steps times and y_vals can hold
+    num_steps = 0 #number of values stored in times and y_vals
     current_time = start_time
     cur_step_size = base_time_step
-    next_relax = -1 #if >0 this is the next time to increase the time step
+    next_relax = -1.0 #if >0 this is the next time to increase the time step
 
     end_cond_val = True #set to false if the end condition is met 
 
@@ -84,82 +538,896 @@ def pynamic_ode(func, start_time, max_time, initial_val,
     not_failed = True #set to false if the solver fails
 
     #add the first step to the array of y values
-    times.append(current_time)
-    y_vals.append(y_cur)
+    times[num_steps] = current_time
+    y_vals[num_steps] = y_cur
+    num_steps += 1
+
+    #the current value of the param to monitor, updated when a step succeeds
+    monitor_cur = y_cur[param_to_monitor]
 
     while current_time < max_time and end_cond_val and not_failed:
         end_val = end_condition(current_time, y_cur, y_old)
-        y_old = np.copy(y_cur)
+        if track_old:
+            y_old[:] = y_cur
         if  end_val != 0:
             end_cond_val = False #we hit the end condition
             status = abs(end_val) #success!
+        elif num_steps == capacity and not grow:
+            not_failed = False
+            status = -2 #out of room to store the results
         else:
-            #first check if the time step should relax
-            if cur_step_size < base_time_step and current_time >= next_relax:
-                #the step should relax, double it
-                next_relax = -1
-                cur_step_size = cur_step_size*2
-                if cur_step_size > base_time_step:
-                    #make sure the base time step isn't exceeded
-                    cur_step_size = base_time_step
-
-            #get the current value of the param to monitor
-            monitor_cur = y_cur[param_to_monitor]
-
             #run the function to get the new derivative values
-            deltas = np.array(func(cur_step_size, y_cur))
+            half_step = cur_step_size/2
+            func(cur_step_size, y_cur, rk4_k1)
 
             if use_rk4:
                 #calculate the derivative multiple times and take the weighted 
-                #average.
-                rk4_k1 = deltas
+                #average. All of this is done in place in the scratch arrays.
 
                 #calculate k2
-                y_for_k2 = y_cur + rk4_k1*(cur_step_size/2)
-                rk4_k2 = np.array(func(cur_step_size/2, y_for_k2))
+                axpy(y_cur, half_step, rk4_k1, y_tmp)
+                func(half_step, y_tmp, rk4_k2)
 
                 #calculate k3
-                y_for_k3 = y_cur + rk4_k2*(cur_step_size/2)
-                rk4_k3 = np.array(func(cur_step_size/2, y_for_k3))
+                axpy(y_cur, half_step, rk4_k2, y_tmp)
+                func(half_step, y_tmp, rk4_k3)
 
                 #calculate k4
-                y_for_k4 = y_cur + rk4_k3*(cur_step_size)
-                rk4_k4 = np.array(func(cur_step_size, y_for_k4))
+                axpy(y_cur, cur_step_size, rk4_k3, y_tmp)
+                func(cur_step_size, y_tmp, rk4_k4)
+
+                #calculate the new values
+                rk4_combine(y_cur, cur_step_size, rk4_k1, rk4_k2, rk4_k3, 
+                            rk4_k4, y_new)
+            else:
+                #calculate the new values
+                axpy(y_cur, cur_step_size, rk4_k1, y_new)
+
+            #accept or reject the step, and set the size of the next one
+            monitor_new = y_new[param_to_monitor]
+            result, current_time, cur_step_size, next_relax = \
+                _control_step(monitor_cur, monitor_new, current_time, 
+                              cur_step_size, next_relax, max_param_delta, 
+                              monitor_atol, base_time_step, min_step_time)
+            if result < 0:
+                not_failed = False
+                status = -1 #time step fail
+            elif result > 0:
+                #the step succeeded, add the new values
+                if num_steps == capacity:
+                    #out of room, double the size of the output arrays
+                    capacity *= 2
+                    times = np.resize(times, capacity)
+                    y_vals = np.resize(y_vals, (capacity, num_vals))
+                times[num_steps] = current_time
+                y_vals[num_steps] = y_new
+                num_steps += 1
+                y_cur, y_new = y_new, y_cur
+                monitor_cur = monitor_new
+
+    return times, y_vals, num_steps, status
+
+@numba.extending.register_jitable(**_JIT_OPTIONS)
+def _control_step(monitor_cur, monitor_new, current_time, cur_step_size, 
+                  next_relax, max_param_delta, monitor_atol, base_time_step, 
+                  min_step_time):
+    """
+    The step size control shared by the fixed step loops (_integrate, 
+    _pynamic_ode_small_jit and the CUDA kernel). Like _axpy it's a plain 
+    function, compiled for whichever loop calls it.
+
+    Inputs:
+        monitor_cur - the monitored value before the step
+        monitor_new - the monitored value after the step
+        current_time - the time before the step
+        cur_step_size - the size of the step
+        next_relax - if >0 this is the next time to increase the step size
+        the rest are the inputs of the same name to pynamic_ode
+
+    Returns:
+        result - 1 if the step is accepted, 0 if it should be retried with 
+                 the new step size and -1 if the step size is already 
+                 minimal (the solver failed)
+        current_time - the time after the step, unchanged if not accepted
+        cur_step_size - the size of the next step
+        next_relax - the updated next_relax
+    """
+    #check the change in the monitor against the allowed change. With
+    #monitor_atol=0 this is |new - cur|/|denom| > max_param_delta but
+    #without the division. If denom_val is 0 both values are 0, so 
+    #this is always finite and a step from 0 to 0 is accepted.
+    denom_val = monitor_new if monitor_new != 0 else monitor_cur
+    if math.fabs(monitor_new - monitor_cur) > \
+            max_param_delta*math.fabs(denom_val) + monitor_atol:
+        #the change was larger than allowed. Reduce the step size and
+        #try again
+
+        #first check if the step size is already minimal, fail if so
+        if cur_step_size <= min_step_time*_MIN_STEP_TOL:
+            return -1, current_time, cur_step_size, next_relax
+
+        #not at the smallest allowed step, so halve the step size
+        cur_step_size = cur_step_size/2
+        if cur_step_size < min_step_time:
+            cur_step_size = min_step_time
+
+        if next_relax < 0:
+            #the time to try increasing step size isn't set, set it
+            next_relax = current_time + base_time_step
+        return 0, current_time, cur_step_size, next_relax
+
+    #the step succeeded
+    current_time += cur_step_size
+
+    #check if the next step should relax. A rejected step always sets 
+    #next_relax after current_time, so this is only needed here.
+    if cur_step_size < base_time_step and current_time >= next_relax:
+        #the step should relax, double it
+        next_relax = -1.0
+        cur_step_size = cur_step_size*2
+        if cur_step_size > base_time_step:
+            #make sure the base time step isn't exceeded
+            cur_step_size = base_time_step
+
+    return 1, current_time, cur_step_size, next_relax
+
+def pynamic_ode_batch(func, start_time, max_time, initial_vals, 
+                      param_to_monitor, max_param_delta,
+                      base_time_step, min_step_time, end_condition,
+                      use_rk4=True, max_steps=_INITIAL_CAPACITY, 
+                      dtype=np.float64, monitor_atol=0.0, first_class=False):
+    """
+    Runs pynamic_ode for many initial values at once, spreading the 
+    independent integrations over all CPU cores. Each row of initial_vals is 
+    the initial_val of one integration, the other inputs are the same as 
+    pynamic_ode and shared by all of them. To sweep over a parameter of func,
+    add it to the values with a derivative of 0.
+
+    The results of every integration are stored in preallocated arrays with 
+    room for max_steps time steps. An integration that runs out of room stops
+    with a status of -2. The values are stored as dtype, np.float32 halves 
+    the memory used by large batches. first_class is the same as for 
+    pynamic_ode.
+    Returns:
+        times     - 2D array of time values [s], one row per integration
+        y_vals    - 3D array of parameter values, indexed by 
+                    [integration, time step, value]
+        num_steps - the number of time steps stored for each integration. 
+                    Entries past this in times and y_vals are undefined.
+        status    - the status of each integration, the same as pynamic_ode 
+                    plus -2 if max_steps was reached. It's a float array if
+                    end_condition returns floats, otherwise an int array.
+    """
+
+    initial_vals = np.array(initial_vals, dtype=dtype, ndmin=2)
+    param_to_monitor = _monitor_index(param_to_monitor, 
+                                      initial_vals.shape[1])
+    loop_func, loop_end_condition, track_old = \
+        _loop_funcs(func, end_condition, initial_vals.dtype, first_class)
+
+    #the status array has to hold whatever end_condition returns, like the 
+    #status of pynamic_ode
+    end_type = _end_condition_type(_jit_end_condition(end_condition)[0], 
+                                   initial_vals.dtype)
+    status_dtype = np.float64 if isinstance(end_type, numba.types.Float) \
+        else np.int64
+    status = np.empty(initial_vals.shape[0], dtype=status_dtype)
+
+    driver = _pynamic_ode_batch_jit_cached if first_class else \
+        _pynamic_ode_batch_jit
+
+    return driver(loop_func, float(start_time), float(max_time), 
+                  initial_vals, param_to_monitor, float(max_param_delta), 
+                  float(monitor_atol), float(base_time_step), 
+                  float(min_step_time), loop_end_condition, track_old, 
+                  bool(use_rk4), int(max_steps), status)
+
+@numba.njit(parallel=True, **_JIT_OPTIONS)
+def _pynamic_ode_batch_jit(func, start_time, max_time, initial_vals, 
+                           param_to_monitor, max_param_delta, monitor_atol,
+                           base_time_step, min_step_time, end_condition,
+                           track_old, use_rk4, max_steps, status):
+    """
+    The compiled version of pynamic_ode_batch. Each integration runs the 
+    whole _integrate loop in its own thread, the RK stages within a step 
+    depend on each other so there's nothing to parallelize there. The status
+    of each integration is written to status, which is allocated by the 
+    caller so its dtype can match end_condition.
+    """
+    num_runs, num_vals = initial_vals.shape
+    times = np.empty((num_runs, max_steps))
+    y_vals = np.empty((num_runs, max_steps, num_vals), initial_vals.dtype)
+    num_steps = np.empty(num_runs, dtype=np.int64)
+
+    for i in numba.prange(num_runs):
+        _, _, num_steps[i], status[i] = \
+            _integrate(func, start_time, max_time, initial_vals[i], 
+                       param_to_monitor, max_param_delta, monitor_atol, 
+                       base_time_step, min_step_time, end_condition, 
+                       track_old, use_rk4, _axpy, _rk4_combine, times[i], 
+                       y_vals[i], False)
+
+    return times, y_vals, num_steps, status
+
+#see _pynamic_ode_jit_cached
+_pynamic_ode_batch_jit_cached = numba.njit(parallel=True, cache=True, 
+    **_JIT_OPTIONS)(_pynamic_ode_batch_jit.py_func)
+
+#threads per block used to launch _make_cuda_kernel() kernels
+_CUDA_BLOCK_SIZE = 128
+
+#compiled CUDA kernels, see _make_cuda_kernel()
+_cuda_kernels = {}
+
+def pynamic_ode_batch_cuda(func, start_time, max_time, initial_vals, 
+                           param_to_monitor, max_param_delta,
+                           base_time_step, min_step_time, end_condition,
+                           use_rk4=True, max_steps=_INITIAL_CAPACITY, 
+                           dtype=np.float64, monitor_atol=0.0):
+    """
+    Version of pynamic_ode_batch that runs on an NVIDIA GPU with numba.cuda.
+    Each integration runs in its own GPU thread, with its scratch values in 
+    thread local memory, so large batches (thousands of integrations or more)
+    of small systems run much faster than on the CPU. np.float32 values are
+    much faster than np.float64 on most consumer GPUs.
+
+    The inputs and outputs are the same as pynamic_ode_batch, except that
+    func must write the derivatives to its third argument:
+        func(time_step, y_vals, derivs)
+    since arrays can't be allocated on the GPU. func and end_condition are 
+    compiled as CUDA device functions, so they can only use what numba.cuda
+    supports (scalar math, indexing the arrays passed in).
+    """
+    if _num_args(func) != 3:
+        raise ValueError("func must take 3 arguments and write the derivatives"
+                         " to the third one to run on the GPU")
+
+    #bound as a module global so the kernels in _make_cuda_kernel() see it
+    global cuda
+    if cuda is None:
+        from numba import cuda
+
+    initial_vals = np.array(initial_vals, dtype=dtype, ndmin=2)
+    num_runs, num_vals = initial_vals.shape
+    param_to_monitor = _monitor_index(param_to_monitor, num_vals)
+
+    kernel = _make_cuda_kernel(func, end_condition, num_vals, 
+                               initial_vals.dtype)
+
+    #the results are only copied back to the host once, after all of the 
+    #integrations are done
+    times = cuda.device_array((num_runs, max_steps))
+    y_vals = cuda.device_array((num_runs, max_steps, num_vals), 
+                               initial_vals.dtype)
+    num_steps = cuda.device_array(num_runs, np.int64)
+    status = cuda.device_array(num_runs, np.int64)
+
+    num_blocks = (num_runs + _CUDA_BLOCK_SIZE - 1)//_CUDA_BLOCK_SIZE
+    kernel[num_blocks, _CUDA_BLOCK_SIZE](
+        float(start_time), float(max_time), cuda.to_device(initial_vals), 
+        param_to_monitor, float(max_param_delta), float(monitor_atol), 
+        float(base_time_step), float(min_step_time), bool(use_rk4), times, 
+        y_vals, num_steps, status)
+
+    return (times.copy_to_host(), y_vals.copy_to_host(), 
+            num_steps.copy_to_host(), status.copy_to_host())
+
+def _make_cuda_kernel(func, end_condition, num_vals, dtype):
+    """
+    Compile the CUDA kernel behind pynamic_ode_batch_cuda for func, 
+    end_condition and the number of values (which sets the size of the 
+    thread local arrays). The kernel runs the same loop as _integrate, one 
+    integration per thread, with grow=False.
+    """
+    key = (func, end_condition, num_vals, dtype)
+    if key in _cuda_kernels:
+        return _cuda_kernels[key]
+
+    device_func = cuda.jit(device=True)(getattr(func, "py_func", func))
+    device_end_condition = cuda.jit(device=True)(
+        getattr(end_condition, "py_func", end_condition))
+    #a constant in the kernel, so the copy is compiled out when not needed
+    track_old = _uses_old_vals(end_condition)
+    if not track_old:
+        device_end_condition = cuda.jit(device=True)(
+            _add_old_vals_arg(device_end_condition))
+    axpy = cuda.jit(device=True)(_axpy)
+    rk4_combine = cuda.jit(device=True)(_rk4_combine)
+    control_step = cuda.jit(device=True)(_control_step)
+    val_type = numba.from_dtype(dtype)
 
-                deltas = (rk4_k1 + 2*rk4_k2 + 2*rk4_k3 + rk4_k4)/6
+    @cuda.jit
+    def kernel(start_time, max_time, initial_vals, param_to_monitor, 
+               max_param_delta, monitor_atol, base_time_step, min_step_time, 
+               use_rk4, times, y_vals, num_steps_out, status_out):
+        run = cuda.grid(1)
+        if run >= initial_vals.shape[0]:
+            return
 
-            #calculate the new values
-            y_new = y_cur + deltas*cur_step_size
+        #scratch arrays, local to this thread
+        y_cur = cuda.local.array(num_vals, val_type)
+        y_old = cuda.local.array(num_vals, val_type)
+        y_new = cuda.local.array(num_vals, val_type)
+        y_tmp = cuda.local.array(num_vals, val_type)
+        rk4_k1 = cuda.local.array(num_vals, val_type)
+        rk4_k2 = cuda.local.array(num_vals, val_type)
+        rk4_k3 = cuda.local.array(num_vals, val_type)
+        rk4_k4 = cuda.local.array(num_vals, val_type)
+        for i in range(num_vals):
+            y_cur[i] = initial_vals[run, i]
+            if track_old:
+                y_old[i] = 0
 
-            #get the new monitor parameter
+        capacity = times.shape[1] #number of steps this run can store
+        num_steps = 0 #number of values stored in times and y_vals
+        current_time = start_time
+        cur_step_size = base_time_step
+        next_relax = -1.0 #if >0 this is the next time to increase the step
+
+        end_cond_val = True #set to false if the end condition is met 
+
+        status = 0 #status of the solver
+        not_failed = True #set to false if the solver fails
+
+        #add the first step to the array of y values
+        times[run, num_steps] = current_time
+        for i in range(num_vals):
+            y_vals[run, num_steps, i] = y_cur[i]
+        num_steps += 1
+
+        #the current value of the param to monitor
+        monitor_cur = y_cur[param_to_monitor]
+
+        while current_time < max_time and end_cond_val and not_failed:
+            end_val = device_end_condition(current_time, y_cur, y_old)
+            if track_old:
+                for i in range(num_vals):
+                    y_old[i] = y_cur[i]
+            if end_val != 0:
+                end_cond_val = False #we hit the end condition
+                status = abs(end_val) #success!
+            elif num_steps == capacity:
+                not_failed = False
+                status = -2 #out of room to store the results
+            else:
+                #take the step, see _integrate
+                half_step = cur_step_size/2
+                device_func(cur_step_size, y_cur, rk4_k1)
+                if use_rk4:
+                    axpy(y_cur, half_step, rk4_k1, y_tmp)
+                    device_func(half_step, y_tmp, rk4_k2)
+                    axpy(y_cur, half_step, rk4_k2, y_tmp)
+                    device_func(half_step, y_tmp, rk4_k3)
+                    axpy(y_cur, cur_step_size, rk4_k3, y_tmp)
+                    device_func(cur_step_size, y_tmp, rk4_k4)
+                    rk4_combine(y_cur, cur_step_size, rk4_k1, rk4_k2, rk4_k3,
+                                rk4_k4, y_new)
+                else:
+                    axpy(y_cur, cur_step_size, rk4_k1, y_new)
+
+                monitor_new = y_new[param_to_monitor]
+                result, current_time, cur_step_size, next_relax = \
+                    control_step(monitor_cur, monitor_new, current_time, 
+                                 cur_step_size, next_relax, max_param_delta,
+                                 monitor_atol, base_time_step, min_step_time)
+                if result < 0:
+                    not_failed = False
+                    status = -1 #time step fail
+                elif result > 0:
+                    #the step succeeded, add the new values
+                    times[run, num_steps] = current_time
+                    for i in range(num_vals):
+                        y_vals[run, num_steps, i] = y_new[i]
+                        y_cur[i] = y_new[i]
+                    num_steps += 1
+                    monitor_cur = monitor_new
+
+        num_steps_out[run] = num_steps
+        status_out[run] = status
+
+    _cuda_kernels[key] = kernel
+    return kernel
+
+@numba.extending.register_jitable(**_JIT_OPTIONS)
+def _axpy(y_vals, scale, derivs, out):
+    """
+    Set out to y_vals + scale*derivs in one pass, without temporary arrays.
+    This is a plain function that compiled code can call or pass on (see 
+    _integrate), _axpy_jit is the compiled version to call from python.
+    """
+    for i in range(y_vals.shape[0]):
+        out[i] = y_vals[i] + scale*derivs[i]
+
+@numba.extending.register_jitable(**_JIT_OPTIONS)
+def _rk4_combine(y_vals, step, rk4_k1, rk4_k2, rk4_k3, rk4_k4, out):
+    """
+    Set out to the RK4 update y_vals + step*(k1 + 2*k2 + 2*k3 + k4)/6 in a 
+    single pass over the arrays.
+    """
+    coeff = step/6
+    for i in range(y_vals.shape[0]):
+        out[i] = y_vals[i] + coeff*(rk4_k1[i] + 2*rk4_k2[i] + 2*rk4_k3[i] + 
+                                    rk4_k4[i])
+
+#compiled versions of _axpy and _rk4_combine for the interpreted loop in 
+#_pynamic_ode_py, used when _pynamic_native hasn't been built
+_axpy_jit = numba.njit(cache=True, **_JIT_OPTIONS)(_axpy)
+_rk4_combine_jit = numba.njit(cache=True, **_JIT_OPTIONS)(_rk4_combine)
+
+def pynamic_ode_small(func, start_time, max_time, initial_val, 
+                      param_to_monitor, max_param_delta,
+                      base_time_step, min_step_time, end_condition,
+                      use_rk4=True, monitor_atol=0.0):
+    """
+    Version of pynamic_ode for systems with only a few values. The values are
+    kept in tuples instead of numpy arrays, which numba keeps on the stack, so
+    no time is spent on array allocation or numpy calls. For small systems 
+    (the tuple arithmetic is unrolled, so think less than ~10 values) this is
+    much faster than pynamic_ode.
+
+    The inputs and outputs are the same as pynamic_ode, except that func and
+    end_condition are passed tuples instead of arrays for y_vals, and func
+    must return the derivatives as a tuple of floats, like:
+        def func(time_step, y_vals):
+            return (y_vals[1], -y_vals[0])
+    """
+
+    y_cur = tuple(float(val) for val in initial_val)
+    y_old = tuple(0.0 for _ in y_cur)
+    param_to_monitor = _monitor_index(param_to_monitor, len(y_cur))
+    #tuples are shared rather than copied, so track_old isn't needed
+    jitted_end_condition, _ = _jit_end_condition(end_condition)
+
+    return _pynamic_ode_small_jit(_jit(func), float(start_time), 
+                                  float(max_time), y_cur, y_old, 
+                                  param_to_monitor, float(max_param_delta), 
+                                  float(monitor_atol), 
+                                  float(base_time_step), float(min_step_time),
+                                  jitted_end_condition, bool(use_rk4))
+
+def _tuple_axpy(y_vals, scale, derivs):
+    """
+    Return the tuple y_vals + scale*derivs. In compiled code this is replaced
+    by the unrolled version from _tuple_axpy_unrolled().
+    """
+    return tuple(y_val + scale*deriv for y_val, deriv in zip(y_vals, derivs))
+
+@numba.extending.overload(_tuple_axpy)
+def _tuple_axpy_unrolled(y_vals, scale, derivs):
+    """
+    Compiled implementation of _tuple_axpy. The code is generated for the 
+    length of the tuples it is called with, so each value is a single 
+    multiply-add and nothing is looped over.
+    """
+    if not isinstance(y_vals, numba.types.BaseTuple):
+        return None
+
+    terms = ["y_vals[%d] + scale*derivs[%d]"%(i, i) for i in range(len(y_vals))]
+    src = "def impl(y_vals, scale, derivs):\n    return (%s,)\n"%\
+        ", ".join(terms)
+    namespace = {}
+    exec(src, namespace)
+    return namespace["impl"]
+
+@numba.njit(**_JIT_OPTIONS)
+def _pynamic_ode_small_jit(func, start_time, max_time, initial_val, 
+                           initial_old, param_to_monitor, max_param_delta,
+                           monitor_atol, base_time_step, min_step_time, 
+                           end_condition, use_rk4):
+    """
+    The compiled integration loop behind pynamic_ode_small. Takes the same 
+    inputs with the values as tuples, plus the initial old values passed to 
+    end_condition, initial_old.
+    """
+
+    #tuples are immutable, so the current values can be shared with y_old and
+    #the output without copying
+    y_cur = initial_val
+    y_old = initial_old
+
+    num_vals = len(y_cur)
+    capacity = _INITIAL_CAPACITY #number of steps times and y_vals can hold
+    times = np.empty(capacity)
+    y_vals = np.empty((capacity, num_vals))
+    num_steps = 0 #number of values stored in times and y_vals
+    current_time = start_time
+    cur_step_size = base_time_step
+    next_relax = -1.0 #if >0 this is the next time to increase the time step
+
+    end_cond_val = True #set to false if the end condition is met 
+
+    status = 0 #status of the solver
+    not_failed = True #set to false if the solver fails
+
+    #add the first step to the array of y values
+    times[num_steps] = current_time
+    for i in range(num_vals):
+        y_vals[num_steps, i] = y_cur[i]
+    num_steps += 1
+
+    #the current value of the param to monitor, updated when a step succeeds
+    monitor_cur = y_cur[param_to_monitor]
+
+    while current_time < max_time and end_cond_val and not_failed:
+        end_val = end_condition(current_time, y_cur, y_old)
+        y_old = y_cur
+        if  end_val != 0:
+            end_cond_val = False #we hit the end condition
+            status = abs(end_val) #success!
+        else:
+            #run the function to get the new derivative values
+            half_step = cur_step_size/2
+            rk4_k1 = func(cur_step_size, y_cur)
+
+            if use_rk4:
+                #calculate the derivative multiple times and take the weighted 
+                #average.
+                rk4_k2 = func(half_step, _tuple_axpy(y_cur, half_step, rk4_k1))
+                rk4_k3 = func(half_step, _tuple_axpy(y_cur, half_step, rk4_k2))
+                rk4_k4 = func(cur_step_size, 
+                              _tuple_axpy(y_cur, cur_step_size, rk4_k3))
+
+                #y_new = y_cur + step*(k1 + 2*k2 + 2*k3 + k4)/6
+                y_new = _tuple_axpy(y_cur, cur_step_size/6, rk4_k1)
+                y_new = _tuple_axpy(y_new, cur_step_size/3, rk4_k2)
+                y_new = _tuple_axpy(y_new, cur_step_size/3, rk4_k3)
+                y_new = _tuple_axpy(y_new, cur_step_size/6, rk4_k4)
+            else:
+                y_new = _tuple_axpy(y_cur, cur_step_size, rk4_k1)
+
+            #accept or reject the step, and set the size of the next one
             monitor_new = y_new[param_to_monitor]
+            result, current_time, cur_step_size, next_relax = \
+                _control_step(monitor_cur, monitor_new, current_time, 
+                              cur_step_size, next_relax, max_param_delta, 
+                              monitor_atol, base_time_step, min_step_time)
+            if result < 0:
+                not_failed = False
+                status = -1 #time step fail
+            elif result > 0:
+                #the step succeeded, add the new values
+                if num_steps == capacity:
+                    #out of room, double the size of the output arrays
+                    capacity *= 2
+                    times = np.resize(times, capacity)
+                    y_vals = np.resize(y_vals, (capacity, num_vals))
+                times[num_steps] = current_time
+                for i in range(num_vals):
+                    y_vals[num_steps, i] = y_new[i]
+                num_steps += 1
+                y_cur = y_new
+                monitor_cur = monitor_new
+
+    return times[:num_steps], y_vals[:num_steps], status
+
+#systems with more values than this are compiled to a function that works on 
+#arrays instead of fully unrolled tuple code, which would take too long to 
+#compile
+_MAX_UNROLLED_VALS = 16
+
+#names that can be used in derivative expressions besides y and h
+_EXPR_NAMESPACE = {name: getattr(math, name) for name in dir(math) 
+                   if not name.startswith("_")}
+_EXPR_NAMESPACE["np"] = np
 
-            #check the percent change in the monitor
-            denom_val = monitor_new if monitor_new != 0 else monitor_cur
-            if denom_val != 0 and \
-                    abs(monitor_new - monitor_cur)/denom_val > max_param_delta:
-                #the change was larger than allowed. Reduce the step size and
-                #try again
+#compiled derivative functions, keyed by the expressions they were made from
+_expr_funcs = {}
+
+def pynamic_ode_expr(derivs, start_time, max_time, initial_val, 
+                     param_to_monitor, max_param_delta,
+                     base_time_step, min_step_time, end_condition,
+                     use_rk4=True, monitor_atol=0.0):
+    """
+    Version of pynamic_ode that takes the derivatives as expressions instead
+    of a function. The expressions are compiled into a derivative function 
+    specialized for this system, so numba can inline them into the RK steps
+    with all loops over the values unrolled. derivs is a list with one 
+    expression per value, written in terms of the values y[0], y[1], ... 
+    and the time step h. Functions from the math module can be used by name.
+    For example, a harmonic oscillator with initial_val = [position, velocity]
+    would be:
+        derivs = ["y[1]", "-y[0]"]
+    SymPy expressions of an IndexedBase named y and a symbol named h can be
+    passed in as well. 
+
+    Systems with up to _MAX_UNROLLED_VALS values run on pynamic_ode_small,
+    larger systems on the array based loop of pynamic_ode. end_condition
+    takes the same arguments as for pynamic_ode, but which loop runs decides
+    how the values are passed to it: as tuples like pynamic_ode_small for up
+    to _MAX_UNROLLED_VALS values, as arrays for larger systems. To work with
+    any number of values it should only index them (y_vals[0] < 0), not use
+    array methods or arithmetic ((y_vals < 0).any()). The other inputs and
+    the outputs are the same as pynamic_ode.
+    """
+
+    y_cur = np.array(initial_val, dtype=np.float64)
+    exprs = tuple(str(deriv) for deriv in derivs)
+    if len(exprs) != y_cur.shape[0]:
+        raise ValueError("expected %d derivative expressions, got %d"%
+                         (y_cur.shape[0], len(exprs)))
+    param_to_monitor = _monitor_index(param_to_monitor, y_cur.shape[0])
+
+    unrolled = len(exprs) <= _MAX_UNROLLED_VALS
+    func = _compile_exprs(exprs, unrolled)
+
+    if unrolled:
+        return pynamic_ode_small(func, start_time, max_time, initial_val, 
+                                 param_to_monitor, max_param_delta, 
+                                 base_time_step, min_step_time, end_condition,
+                                 use_rk4, monitor_atol)
+
+    jitted_end_condition, track_old = _jit_end_condition(end_condition)
+
+    return _pynamic_ode_jit(func, float(start_time), float(max_time), y_cur, 
+                            param_to_monitor, float(max_param_delta), 
+                            float(monitor_atol), float(base_time_step), 
+                            float(min_step_time), jitted_end_condition, 
+                            track_old, bool(use_rk4))
+
+def _compile_exprs(exprs, unrolled):
+    """
+    Generate and compile a derivative function from the expressions. If 
+    unrolled, the function returns a tuple for pynamic_ode_small:
+        func(h, y) -> (expr_0, expr_1, ...)
+    otherwise it writes the derivatives to an array, like _as_inplace():
+        func(h, y, dy)
+    The compiled function is inlined into the integration loop by numba.
+    """
+    key = (exprs, unrolled)
+    if key not in _expr_funcs:
+        if unrolled:
+            src = "def func(h, y):\n    return (%s,)\n"%", ".join(exprs)
+        else:
+            lines = ["    dy[%d] = %s\n"%(i, expr) 
+                     for i, expr in enumerate(exprs)]
+            src = "def func(h, y, dy):\n" + "".join(lines)
+
+        namespace = dict(_EXPR_NAMESPACE)
+        exec(src, namespace)
+        _expr_funcs[key] = numba.njit(inline='always', fastmath=True, 
+                                      error_model='numpy')(namespace["func"])
+    return _expr_funcs[key]
+
+#Butcher tableau for the Dormand-Prince 5(4) method. The E values are the 
+#difference between the 5th and 4th order weights, used for the error estimate.
+_DP_C2, _DP_C3, _DP_C4, _DP_C5 = 1/5, 3/10, 4/5, 8/9
+_DP_A21 = 1/5
+_DP_A31, _DP_A32 = 3/40, 9/40
+_DP_A41, _DP_A42, _DP_A43 = 44/45, -56/15, 32/9
+_DP_A51, _DP_A52, _DP_A53, _DP_A54 = \
+    19372/6561, -25360/2187, 64448/6561, -212/729
+_DP_A61, _DP_A62, _DP_A63, _DP_A64, _DP_A65 = \
+    9017/3168, -355/33, 46732/5247, 49/176, -5103/18656
+_DP_A71, _DP_A73, _DP_A74, _DP_A75, _DP_A76 = \
+    35/384, 500/1113, 125/192, -2187/6784, 11/84
+_DP_E1, _DP_E3, _DP_E4, _DP_E5, _DP_E6, _DP_E7 = \
+    71/57600, -71/16695, 71/1920, -17253/339200, 22/525, -1/40
+
+#limits on how much the step size can change after a step
+_MIN_STEP_FACTOR = 0.2
+_MAX_STEP_FACTOR = 5.0
+_STEP_SAFETY = 0.9
+
+#exponents of the PI step size controller, the values Hairer uses for DOPRI5
+#(beta = 0.04, alpha = 1/5 - 0.75*beta)
+_PI_ALPHA = 0.17
+_PI_BETA = 0.04
+
+def pynamic_ode_dp5(func, start_time, max_time, initial_val, 
+                    rtol, atol, base_time_step, min_step_time, end_condition,
+                    dtype=np.float64, first_class=False):
+    """
+    Solves a system of ordinary differential equations with the Dormand-Prince
+    5(4) method. Each step gives a 5th and a 4th order estimate of the new
+    values from the same derivative evaluations, and the difference between 
+    them is used as the error of the step. A step is accepted if the error of 
+    every value is within atol + rtol*|value|. The next step size is chosen 
+    with a PI controller, from the error of this step and the previous one, 
+    which avoids the step size swinging up and down when the error is close 
+    to the tolerance so most steps are accepted on the first try. The 
+    derivatives at the end of an accepted step are reused for the start of 
+    the next one (first same as last), so a step costs 6 calls to func.
+
+    func and end_condition are the same as for pynamic_ode. func is passed 
+    the step the derivative is calculated for, which for the first stage of a
+    step is the previous step size.
+    Inputs:
+        func             - function that takes time step and values, returns 
+                           derivatives
+        start_time       - simulation start time [s]
+        max_time         - maximum time to run simulation before returning an 
+                           error [s]
+        initial_val      - array with initial parameter values
+        rtol             - relative tolerance of the error in each value
+        atol             - absolute tolerance of the error in each value
+        base_time_step   - the first step size to try, and the largest step 
+                           size allowed [s]
+        min_step_time    - the smallest time step to allow. If the error is 
+                           too large at the smallest allowed time step an 
+                           error status will be returned.
+        end_condition    - function that takes current time and values and
+                           (optionally) the previous values. It will return
+                           not 0 if the integration should end, 0 otherwise. The
+                           value of end condition will be passed out of this 
+                           function.
+        dtype            - default is np.float64. The float type the values 
+                           are stored as, see pynamic_ode.
+        first_class      - default is False. If True, pass func and 
+                           end_condition to the loop as first class 
+                           functions, see pynamic_ode.
+    Returns:
+        times  - the array of time values [s] calculated 
+        y_vals - 2D array of parameter values, one row per time step
+        status - the status of the solver, the same as pynamic_ode. -1 means 
+                 the error was too large at the smallest allowed time step.
+    """
+
+    y_cur = np.array(initial_val, dtype=dtype)
+
+    loop_func, loop_end_condition, track_old = \
+        _loop_funcs(func, end_condition, y_cur.dtype, first_class)
+    driver = _pynamic_ode_dp5_jit_cached if first_class else \
+        _pynamic_ode_dp5_jit
+
+    return driver(loop_func, float(start_time), float(max_time), y_cur, 
+                  float(rtol), float(atol), float(base_time_step), 
+                  float(min_step_time), loop_end_condition, track_old)
+
+@numba.njit(**_JIT_OPTIONS)
+def _pynamic_ode_dp5_jit(func, start_time, max_time, initial_val, rtol, atol,
+                         base_time_step, min_step_time, end_condition,
+                         track_old):
+    """
+    The compiled integration loop behind pynamic_ode_dp5. Takes the same 
+    inputs, with func, end_condition and track_old from _loop_funcs().
+    """
+
+    y_cur = initial_val
+    #see _integrate
+    if track_old:
+        y_old = np.zeros_like(y_cur)
+    else:
+        y_old = np.empty_like(y_cur)
+
+    #scratch arrays reused every step so the loop doesn't allocate
+    num_vals = y_cur.shape[0]
+    dp_k1 = np.empty_like(y_cur)
+    dp_k2 = np.empty_like(y_cur)
+    dp_k3 = np.empty_like(y_cur)
+    dp_k4 = np.empty_like(y_cur)
+    dp_k5 = np.empty_like(y_cur)
+    dp_k6 = np.empty_like(y_cur)
+    dp_k7 = np.empty_like(y_cur)
+    y_tmp = np.empty_like(y_cur)
+    y_new = np.empty_like(y_cur)
+
+    capacity = _INITIAL_CAPACITY #number of steps times and y_vals can hold
+    times = np.empty(capacity)
+    y_vals = np.empty((capacity, num_vals), y_cur.dtype)
+    num_steps = 0 #number of values stored in times and y_vals
+    current_time = start_time
+    cur_step_size = base_time_step
+    err_prev = 1.0 #error of the last accepted step, for the PI controller
+
+    end_cond_val = True #set to false if the end condition is met 
+
+    status = 0 #status of the solver
+    not_failed = True #set to false if the solver fails
+
+    #add the first step to the array of y values
+    times[num_steps] = current_time
+    y_vals[num_steps] = y_cur
+    num_steps += 1
+
+    #the first stage of each step, updated from the last stage of the previous
+    #accepted step
+    func(cur_step_size, y_cur, dp_k1)
+
+    while current_time < max_time and end_cond_val and not_failed:
+        end_val = end_condition(current_time, y_cur, y_old)
+        if track_old:
+            y_old[:] = y_cur
+        if  end_val != 0:
+            end_cond_val = False #we hit the end condition
+            status = abs(end_val) #success!
+        else:
+            step = cur_step_size
+
+            #calculate the remaining stages
+            for i in range(num_vals):
+                y_tmp[i] = y_cur[i] + step*_DP_A21*dp_k1[i]
+            func(_DP_C2*step, y_tmp, dp_k2)
+
+            for i in range(num_vals):
+                y_tmp[i] = y_cur[i] + step*(_DP_A31*dp_k1[i] + 
+                                            _DP_A32*dp_k2[i])
+            func(_DP_C3*step, y_tmp, dp_k3)
+
+            for i in range(num_vals):
+                y_tmp[i] = y_cur[i] + step*(_DP_A41*dp_k1[i] + 
+                                            _DP_A42*dp_k2[i] + 
+                                            _DP_A43*dp_k3[i])
+            func(_DP_C4*step, y_tmp, dp_k4)
+
+            for i in range(num_vals):
+                y_tmp[i] = y_cur[i] + step*(_DP_A51*dp_k1[i] + 
+                                            _DP_A52*dp_k2[i] + 
+                                            _DP_A53*dp_k3[i] + 
+                                            _DP_A54*dp_k4[i])
+            func(_DP_C5*step, y_tmp, dp_k5)
+
+            for i in range(num_vals):
+                y_tmp[i] = y_cur[i] + step*(_DP_A61*dp_k1[i] + 
+                                            _DP_A62*dp_k2[i] + 
+                                            _DP_A63*dp_k3[i] + 
+                                            _DP_A64*dp_k4[i] + 
+                                            _DP_A65*dp_k5[i])
+            func(step, y_tmp, dp_k6)
+
+            #the 5th order solution, which is also the input to the last stage
+            for i in range(num_vals):
+                y_new[i] = y_cur[i] + step*(_DP_A71*dp_k1[i] + 
+                                            _DP_A73*dp_k3[i] + 
+                                            _DP_A74*dp_k4[i] + 
+                                            _DP_A75*dp_k5[i] + 
+                                            _DP_A76*dp_k6[i])
+            func(step, y_new, dp_k7)
+
+            #the RMS of the error in each value relative to its tolerance
+            err_sum = 0.0
+            for i in range(num_vals):
+                val_err = step*(_DP_E1*dp_k1[i] + _DP_E3*dp_k3[i] + 
+                                _DP_E4*dp_k4[i] + _DP_E5*dp_k5[i] + 
+                                _DP_E6*dp_k6[i] + _DP_E7*dp_k7[i])
+                val_tol = atol + rtol*max(math.fabs(y_cur[i]), 
+                                          math.fabs(y_new[i]))
+                err_sum += (val_err/val_tol)**2
+            err = np.sqrt(err_sum/num_vals)
+
+            if err > 1:
+                #the error was too large, retry with a smaller step
 
                 #first check if the step size is already minimal, fail if so
-                if cur_step_size == min_step_time:
+                if cur_step_size <= min_step_time*_MIN_STEP_TOL:
                     not_failed = False
                     status = -1 #time step fail
                 else:
-                    #not at the smallest allowed step, so halve the step size
-                    cur_step_size = cur_step_size/2
-                    if cur_step_size < min_step_time:
-                        cur_step_size = min_step_time
-
-                    if next_relax < 0:
-                        #the time to try increasing step size isn't set, set it
-                        next_relax = current_time + base_time_step
-                
+                    #only use this step's error to pick the retry step size
+                    step_factor = max(_MIN_STEP_FACTOR, 
+                                      _STEP_SAFETY*err**-0.2)
+                    cur_step_size = max(min_step_time, 
+                                        cur_step_size*step_factor)
             else:
                 #the step succeeded, add the new values and increment
                 current_time += cur_step_size
-                y_vals.append(y_new)
-                times.append(current_time)
-                y_cur = y_new
+                if num_steps == capacity:
+                    #out of room, double the size of the output arrays
+                    capacity *= 2
+                    times = np.resize(times, capacity)
+                    y_vals = np.resize(y_vals, (capacity, num_vals))
+                times[num_steps] = current_time
+                y_vals[num_steps] = y_new
+                num_steps += 1
+                y_cur, y_new = y_new, y_cur
+
+                #the last stage is the first stage of the next step
+                dp_k1, dp_k7 = dp_k7, dp_k1
+
+                #the PI controller, the step size that should give an error of
+                #~1 (the tolerance) next step
+                if err == 0:
+                    step_factor = _MAX_STEP_FACTOR
+                else:
+                    step_factor = min(_MAX_STEP_FACTOR, 
+                                      max(_MIN_STEP_FACTOR, 
+                                          _STEP_SAFETY*err**-_PI_ALPHA*
+                                          err_prev**_PI_BETA))
+                err_prev = max(err, 1e-4)
+
+                cur_step_size = min(base_time_step, cur_step_size*step_factor)
+
+    return times[:num_steps], y_vals[:num_steps], status
 
-    return times, y_vals, status
+#see _pynamic_ode_jit_cached
+_pynamic_ode_dp5_jit_cached = numba.njit(cache=True, **_JIT_OPTIONS)(
+    _pynamic_ode_dp5_jit.py_func)
@@ -1,23 +1,21 @@
-import time
-import matplotlib.pyplot as plt
-from pynamic import pynamic_ode
+import timeit
+from pynamic import pynamic_ode, pynamic_ode_small, pynamic_ode_expr, \
+    pynamic_ode_batch, pynamic_ode_dp5
 import numpy as np
 
 def pynamic_test():
     """
     Validate the ode integrator with this function. This function will plot the
     function dy(t)/dt=-2y(t), which has the solution y(t)=3e^(-2t) for t>=0.
-    The test will plot the results of pynamic compared to the true solution.
+    The test will plot the results of pynamic compared to the true solution,
+    and check the accuracy of every entry point against it.
     """
-
-    sol_times = np.linspace(0, 3, 25)
-
-    #the true solution to the ODE
-    sol_ys = 3*np.exp(-2*sol_times)
+    #only needed for the plot, and slow to import
+    import matplotlib.pyplot as plt
 
     #the parameters for pynamic_ode
-    def test_func(_, y_vals):
-        return -2*y_vals
+    def test_func(_, y_vals, derivs):
+        derivs[0] = -2*y_vals[0]
 
     start_time = 0
     max_time = 2
@@ -32,31 +30,67 @@ def pynamic_test():
             return 1
         return 0
 
-    start = time.time()
-    times, y_vals, status = pynamic_ode(test_func, start_time, max_time, 
-                                        initial_val, param_to_monitor, 
-                                        max_param_delta, base_time_step, 
-                                        min_step_time, end_condition, 
-                                        use_rk4=False)
-    end = time.time()
-    print("time to run with RK1: %2.3e"%(end-start))
-
-    start = time.time()
-    t_rk4, y_rk4s, st_rk4 = pynamic_ode(test_func, start_time, max_time, 
-                                        initial_val, param_to_monitor, 
-                                        max_param_delta, base_time_step, 
-                                        min_step_time, end_condition, 
-                                        use_rk4=True)
-    end = time.time()
-    print("time to run with RK4: %2.3e"%(end-start))
-
-    sol_times = np.linspace(0, max_time, max_time*15)
+    def run_pynamic(use_rk4):
+        return pynamic_ode(test_func, start_time, max_time, initial_val, 
+                           param_to_monitor, max_param_delta, base_time_step, 
+                           min_step_time, end_condition, use_rk4=use_rk4)
 
-    #the true solution to the ODE
-    sol_ys = 3*np.exp(-2*sol_times)
+    #the first run of each method also compiles it, so get the results first
+    #and time repeated runs afterwards
+    times, y_vals, status = run_pynamic(False)
+    t_rk4, y_rk4s, st_rk4 = run_pynamic(True)
 
+    num_runs = 1000
+    for name, use_rk4 in (("RK1", False), ("RK4", True)):
+        run_times = timeit.repeat(lambda: run_pynamic(use_rk4), repeat=5, 
+                                  number=num_runs)
+        print("time to run with %s: %2.3e"%(name, min(run_times)/num_runs))
+
+    #the true solution to the ODE
+    sol_times = np.linspace(0.0, max_time, int(max_time*15))
+    sol_ys = 3.0*np.exp(-2.0*sol_times)
 
     print("status of solver: %d, status with RK4: %d"%(status, st_rk4))
+
+    #the largest error relative to the true solution, which RK1 and the scipy
+    #backend (which uses max_param_delta as its rtol) only keep roughly 
+    #within max_param_delta
+    def max_rel_error(times, y_vals):
+        true_ys = 3.0*np.exp(-2.0*np.asarray(times))
+        return np.max(np.abs(np.asarray(y_vals)[:, 0] - true_ys)/true_ys)
+
+    args = (start_time, max_time, initial_val, param_to_monitor, 
+            max_param_delta, base_time_step, min_step_time, end_condition)
+    results = []
+    for name, use_rk4, max_error in (("RK1", False, 0.15), 
+                                     ("RK4", True, 1e-5)):
+        results.append((name, pynamic_ode(test_func, *args, 
+                                          use_rk4=use_rk4), max_error))
+        results.append((name + " jit=False", pynamic_ode(
+            test_func, *args, use_rk4=use_rk4, jit=False), max_error))
+        results.append((name + " small", pynamic_ode_small(
+            lambda _, y_vals: (-2*y_vals[0],), *args, use_rk4=use_rk4), 
+                        max_error))
+        results.append((name + " expr", pynamic_ode_expr(
+            ["-2*y[0]"], *args, use_rk4=use_rk4), max_error))
+        b_times, b_ys, num_steps, b_status = pynamic_ode_batch(
+            test_func, *args, use_rk4=use_rk4)
+        results.append((name + " batch", (b_times[0, :num_steps[0]], 
+                                          b_ys[0, :num_steps[0]], 
+                                          b_status[0]), max_error))
+    results.append(("scipy", pynamic_ode(test_func, *args, backend='scipy'), 
+                    0.25))
+    results.append(("dp5", pynamic_ode_dp5(
+        test_func, start_time, max_time, initial_val, 1e-6, 1e-9, 
+        base_time_step, min_step_time, end_condition), 1e-5))
+
+    for name, (res_times, res_ys, res_status), max_error in results:
+        error = max_rel_error(res_times, res_ys)
+        print("%s: status %d, max relative error %2.3e"%(name, res_status, 
+                                                         error))
+        assert res_status == 1, "%s didn't reach the end condition"%name
+        assert error < max_error, "%s error %2.3e is above %2.3e"%(
+            name, error, max_error)
     plt.plot(sol_times, sol_ys, 'k', label="True Sol.")
 
     plt.plot(times, y_vals, 'r+', label="RK1")
@@ -70,4 +104,5 @@ def pynamic_test():
 
     return 0
 
-pynamic_test()
+if __name__ == '__main__':
+    pynamic_test()